@@ -1,13 +1,17 @@
 import streamlit as st
+import atexit
 import random
 import time
 import uuid
-from datetime import datetime
-from transformers import pipeline
-from supabase import create_client
-import json
+import hashlib
+import logging
+import queue
+import threading
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
 import traceback
 
+logger = logging.getLogger(__name__)
 
 
 
@@ -16,41 +20,103 @@ import traceback
 # --------------------
 
 
-# Create Supabase client
+# Create Supabase client (once per process, not on every rerun)
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+@st.cache_resource
+def get_supabase():
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+supabase = get_supabase()
+
 
+# Load Hugging Face tokenizer and model (eval mode; BF16 autocast at inference).
+# Weights stay FP32 unless IPEX is applied, which casts them to BF16.
+# Cached separately; both use MODEL_NAME, as do the cache keys.
+# torch/transformers are imported lazily, on the first disk-cache miss. With
+# Hugging Face mode on that is usually warm_guidelines() on the first script
+# run; mock mode never loads them.
+MODEL_NAME = "t5-small"
 
-# Load Hugging Face model
 @st.cache_resource
-def load_hf_model():
-    return pipeline("text2text-generation", model="t5-small")
+def load_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(MODEL_NAME)
 
-hf_model = load_hf_model()
+# IPEX builds are tied to one torch major.minor; a mismatched build calls
+# exit() on import instead of raising, so check the version before importing
+def ipex_matches_torch():
+    import torch
+    from importlib.metadata import version, PackageNotFoundError
 
+    try:
+        ipex_version = version("intel_extension_for_pytorch")
+    except PackageNotFoundError:
+        return False
+    return ipex_version.split(".")[:2] == torch.__version__.split(".")[:2]
+
+@st.cache_resource
+def load_model():
+    import torch
+    from transformers import AutoModelForSeq2SeqLM
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME)
+    model.eval()
+
+    # Use Intel Extension for PyTorch's CPU kernels when a matching build is installed (optional)
+    if ipex_matches_torch():
+        try:
+            import intel_extension_for_pytorch as ipex
+            model = ipex.optimize(model, dtype=torch.bfloat16)
+        except (Exception, SystemExit):  # a broken IPEX install can exit() on import
+            logger.exception("IPEX unavailable, using stock PyTorch")
+
+    # Compile the forward pass (generate() calls it once per token) and warm it
+    # up here, so compilation happens at load time rather than on the first click
+    eager_forward = model.forward
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", backend="inductor", dynamic=True)
+    try:
+        warmup = load_tokenizer()("summarize: warm up", return_tensors="pt")
+        with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16):
+            model.generate(**warmup, max_new_tokens=8)
+    except Exception:
+        model.forward = eager_forward  # no working compiler toolchain, stay eager
+
+    return model
 
 # Toggle AI model source
-USE_HF = st.sidebar.toggle("Use Hugging Face AI", value=True)
-st.sidebar.markdown("Model: `t5-small`")
+USE_HF = st.sidebar.toggle("Use Hugging Face AI", value=True, key="use_hf")
+st.sidebar.markdown(f"Model: `{MODEL_NAME}`")
 
 # Simulate failure mode
-st.session_state.simulate_failure = st.sidebar.checkbox("Simulate random failure?", value=False)
+st.sidebar.checkbox("Simulate random failure?", value=False, key="simulate_failure")
+
+# Debug output (Supabase payloads, tracebacks)
+st.sidebar.checkbox("Debug", value=False, key="debug")
+
+# AI outputs collected over the workflow
+@dataclass(slots=True)
+class WorkflowInputs:
+    summary: str = ""
+    guidelines: str = ""
 
 # Initialize session state
-if "session_id" not in st.session_state:
-    st.session_state.session_id = str(uuid.uuid4())
-if "stage" not in st.session_state:
-    st.session_state.stage = 1
-if "inputs" not in st.session_state:
-    st.session_state.inputs = {}
-if "stage_start_time" not in st.session_state:
-    st.session_state.stage_start_time = datetime.utcnow()
-if "last_activity_time" not in st.session_state:
-    st.session_state.last_activity_time = datetime.utcnow()
-if "supabase_user" in st.session_state:
-    supabase.auth.set_session(st.session_state["supabase_user"]["session"])
+# The UUID and clock reads are guarded so they only run for a new session
+def init_session():
+    ss = st.session_state
+    ss.setdefault("stage", 1)
+    if "inputs" not in ss:
+        ss.inputs = WorkflowInputs()
+    if "session_id" not in ss:
+        ss.session_id = str(uuid.uuid4())
+    if "stage_start_time" not in ss:
+        now = datetime.now(timezone.utc)
+        ss.stage_start_time = now
+        ss.last_activity_time = now
+
+init_session()
 
 stage = st.session_state.stage
 
@@ -61,13 +127,16 @@ stage = st.session_state.stage
 # --------------------
 
 #Supabase Logging Function
+# Events are queued for the background writer as they happen, so stage
+# transitions don't wait on a Supabase round-trip.
 def log_to_supabase(stage_number, user_input, ai_output, button_clicked, completed=False):
-    now = datetime.utcnow()
-    last_start_time = st.session_state.get("stage_start_time", now)
+    ss = st.session_state
+    now = datetime.now(timezone.utc)
+    last_start_time = ss.get("stage_start_time", now)
     duration = (now - last_start_time).total_seconds()
 
     data = {
-        "session_id": st.session_state.session_id,
+        "session_id": ss.session_id,
         "stage_number": stage_number,
         "user_input": user_input,
         "ai_output": ai_output,
@@ -75,39 +144,84 @@ def log_to_supabase(stage_number, user_input, ai_output, button_clicked, complet
         "timestamp_end": now.isoformat(),
         "duration_sec": int(duration),
         "abandoned_at_stage": stage_number if not completed else None,
-        "search_frequency": st.session_state.get("search_frequency", 0),
+        "search_frequency": ss.get("search_frequency", 0),
         "button_clicked": button_clicked,
         "completed": completed,
         "last_info_received_prior_to_abandonment": ai_output if not completed else None
     }
 
     # Show debug payload
-    st.subheader("🟡 Data being sent to Supabase:")
-    st.code(json.dumps(data, indent=2), language="json")
-    
-    try:
-        payload = data
-        response = supabase.table("user_events").insert(payload).execute()
+    if ss.get("debug"):
+        st.json(data)
 
-        # Cross-version safe checks
-        err = getattr(response, "error", None)
-        rows = getattr(response, "data", None)
+    get_log_queue().put(data)
 
-        if err:
-            st.error("Insert failed")
-            st.code(str(err))
-        else:
-            st.success("✅ Logged to Supabase")
-            st.write("Returned data:", rows)
+    # Always update activity timestamps
+    ss.stage_start_time = now
+    ss.last_activity_time = now
 
-    except Exception as e:
-        st.error("❌ Failed to insert into Supabase")
-        st.code(str(e))
-        st.code(traceback.format_exc())
+def insert_events(client, rows):
+    try:
+        response = client.table("user_events").insert(rows).execute()
 
-    # Always update activity timestamps
-    st.session_state.stage_start_time = now
-    st.session_state.last_activity_time = now
+        # Cross-version safe check
+        err = getattr(response, "error", None)
+        if err:
+            logger.error("Supabase insert failed: %s", err)
+    except Exception:
+        logger.exception("Failed to insert %d events into Supabase", len(rows))
+
+# Background writer: inserts queued events off the script thread, so
+# logging never blocks a rerun on the Supabase round-trip.
+# Rows taken off the queue are kept in `pending` until inserted; the lock is
+# held during the insert, so the exit hook never drops or re-sends them.
+def drain_logs(log_queue, client, pending, lock):
+    while True:
+        row = log_queue.get()
+        with lock:
+            pending.append(row)
+
+        # Anything else queued within 200 ms goes into the same insert
+        deadline = time.monotonic() + 0.2
+        while len(pending) < 500:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            with lock:
+                pending.append(row)
+
+        with lock:
+            if pending:  # may already have been sent by the exit hook
+                insert_events(client, pending)
+                pending.clear()
+
+# On shutdown the daemon writer is killed mid-wait, so insert its in-progress
+# batch and whatever is still queued in one final batch
+def flush_on_exit(log_queue, client, pending, lock):
+    with lock:
+        while True:
+            try:
+                pending.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if pending:
+            insert_events(client, pending)
+            pending.clear()
+
+# One queue and writer thread per process, not per rerun
+@st.cache_resource
+def get_log_queue():
+    log_queue = queue.Queue()
+    pending = []
+    lock = threading.Lock()
+    args = (log_queue, supabase, pending, lock)
+    threading.Thread(target=drain_logs, args=args, daemon=True).start()
+    atexit.register(flush_on_exit, *args)
+    return log_queue
 
 
 
@@ -116,16 +230,114 @@ def log_to_supabase(stage_number, user_input, ai_output, button_clicked, complet
 # AI
 # --------------------
 
+GUIDELINES_PROMPT = "Provide imaging guidelines based on patient symptoms."
+
+# Generation limits: T5 was trained on 512-token inputs, and short outputs
+# keep the decode loop (and its KV cache) small
+MAX_INPUT_TOKENS = 512
+MAX_NEW_TOKENS = 64
+
+# Generated text is derived from patient input, so cached copies expire
+# after a day, on disk as well as in memory
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+
+# On-disk response cache so outputs survive Streamlit restarts
+@st.cache_resource
+def get_disk_cache():
+    import diskcache
+    return diskcache.Cache(".llm_cache", size_limit=2**30)
+
+# Collapse whitespace so re-typed inputs hit the cache. Case is kept:
+# T5 is case-sensitive and clinical abbreviations can depend on it.
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+# The generation limits are part of the key: changing them changes the output,
+# so entries written under old limits must not be served
+def cache_key(prompt):
+    return hashlib.sha1(f"{MODEL_NAME}:{MAX_INPUT_TOKENS}:{MAX_NEW_TOKENS}:{prompt}".encode()).hexdigest()
+
+# Cache model output by prompt so reruns don't repeat inference.
+# Only the prompts are hashed; the model is only loaded on a disk-cache miss.
+# Prompts are run as one padded batch so several outputs share a single generate call;
+# prompts already in the disk cache are left out of the batch.
+@st.cache_data(ttl=RESPONSE_CACHE_TTL, max_entries=256, show_spinner=False)
+def cached_generate(prompts):
+    keys = [cache_key(p) for p in prompts]
+    # The disk cache is only an optimisation: if it can't be opened or read
+    # (e.g. a read-only .llm_cache), generate everything instead
+    try:
+        disk_cache = get_disk_cache()
+        results = [disk_cache.get(k) for k in keys]
+    except Exception:
+        logger.exception("Disk cache unavailable, generating without it")
+        disk_cache = None
+        results = [None] * len(prompts)
+    missing = [i for i, r in enumerate(results) if r is None]
+
+    if missing:
+        import torch
+
+        tokenizer = load_tokenizer()
+        hf_model = load_model()
+        batch = tokenizer(
+            [prompts[i] for i in missing],
+            return_tensors="pt", padding=True, truncation=True, max_length=MAX_INPUT_TOKENS,
+        )
+        with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16):
+            out = hf_model.generate(
+                **batch, max_new_tokens=MAX_NEW_TOKENS, num_beams=1, do_sample=False, use_cache=True
+            )
+        for i, text in zip(missing, tokenizer.batch_decode(out, skip_special_tokens=True)):
+            results[i] = text
+
+        if disk_cache is not None:
+            try:
+                for i in missing:
+                    disk_cache.set(keys[i], results[i], expire=RESPONSE_CACHE_TTL)
+            except Exception:
+                logger.exception("Could not write responses to the disk cache")
+
+    return results
+
+# Placeholder output when the Hugging Face model is switched off
+def mock_generate(prompts):
+    return [f"[Mock AI] {p}" for p in prompts]
+
+def run_model(prompts):
+    return cached_generate(prompts) if USE_HF else mock_generate(prompts)
+
 def generate_response(prompt):
     try:
-        result = hf_model(prompt, max_length=200, do_sample=False)
-        return result[0]["generated_text"]
+        return run_model((normalize_prompt(prompt),))[0]
     except Exception as e:
         return f"[AI Error] {e}"
 
+# Summary and guidelines in one batch, so stage 4 doesn't need its own model call
+def precompute_outputs(patient_input):
+    try:
+        prompts = (normalize_prompt(f"summarize: {patient_input}"), GUIDELINES_PROMPT)
+        summary, guidelines = run_model(prompts)
+    except Exception as e:
+        # Leave guidelines empty so stage 4 retries the model itself
+        summary, guidelines = f"[AI Error] {e}", ""
+    return {"summary": summary, "guidelines": guidelines}
+
+# The guideline prompt never changes, so generate it once per process at
+# startup. Stage 1 then finds it in the disk cache and only runs the summary.
+@st.cache_resource(show_spinner=False)
+def warm_guidelines():
+    cached_generate((GUIDELINES_PROMPT,))
+
+if USE_HF:
+    try:
+        warm_guidelines()
+    except Exception:
+        logger.exception("Could not pre-generate guidelines")
+
 # Simulate random failure
 def maybe_fail():
-    return random.choice([True, False]) if st.session_state.simulate_failure else True
+    return bool(random.getrandbits(1)) if st.session_state.get("simulate_failure") else True
 
 # --------------------
 # UI & STAGES
@@ -135,26 +347,34 @@ st.title("🧠 Agentic AI Workflow Demo")
 
 stage = st.session_state.stage
 
+# Each stage is a fragment: widget interactions inside a stage only rerun
+# that stage. Stage changes still call st.rerun() to redraw the whole app;
+# in-stage actions like Retry use st.rerun(scope="fragment").
+
 # STAGE 1: Clinician enters patient notes 
-if stage == 1:
+@st.fragment
+def render_stage1():
     st.subheader("Step 1: Detect Patient Record Entry")
     st.markdown("Clinician enters symptoms and history.")
 
     patient_input = st.text_area("Enter patient symptoms/history:")
     if st.button("Detect and Summarize Entry"):
-        if patient_input.strip() == "":
+        if not patient_input or patient_input.isspace():
             st.warning("Please enter some text before proceeding.")
         else:
-            summary = generate_response(f"summarize: {patient_input}")
-            st.session_state.inputs["summary"] = summary
+            outputs = precompute_outputs(patient_input)
+            inputs = st.session_state.inputs
+            summary = inputs.summary = outputs["summary"]
+            inputs.guidelines = outputs["guidelines"]
             log_to_supabase(1, patient_input, summary, "Detect and Summarize Entry")
             st.session_state.stage = 2
             st.rerun()
 
 # STAGE 2: Agent extracts key data
-elif stage == 2:
+@st.fragment
+def render_stage2():
     st.subheader("Step 2: Summary Output")
-    st.info(st.session_state.inputs.get("summary", "[No summary found]"))
+    st.info(st.session_state.inputs.summary or "[No summary found]")
 
     if st.button("Proceed to attach summarisation"):
         log_to_supabase(2, "Confirmed summary", "", "Proceed to attach summarisation")
@@ -162,7 +382,8 @@ elif stage == 2:
         st.rerun()
 
 # STAGE 3: Prompt to attach guidelines
-elif stage == 3:
+@st.fragment
+def render_stage3():
     st.subheader("Step 3: Fetch Guidelines?")
     st.markdown("Would you like the agent to fetch relevant imaging guidelines?")
 
@@ -176,35 +397,45 @@ elif stage == 3:
         st.stop()
 
 # STAGE 4: Agent retrieves guidelines
-elif stage == 4:
+@st.fragment
+def render_stage4():
     st.subheader("Step 4: Retrieving Guidelines")
 
-    try:
-        success = maybe_fail()
+    # A failed fetch is remembered, so clicking Retry or Stop doesn't itself
+    # trigger another attempt; Retry clears it and reruns only this fragment
+    if not st.session_state.get("guidelines_failed"):
+        # Only the fetch itself is guarded: st.rerun()/st.stop() raise Streamlit
+        # control-flow exceptions, which `except Exception` would swallow
+        try:
+            success = maybe_fail()
+            if success:
+                guidelines = st.session_state.inputs.guidelines or generate_response(GUIDELINES_PROMPT)
+        except Exception as e:
+            st.error(f"❌ Error in Step 4: {e}")
+            if st.session_state.get("debug"):
+                st.text(traceback.format_exc())
+            st.stop()  # Halt execution so I can see the error
+
         if success:
-            guidelines = generate_response("Provide imaging guidelines based on patient symptoms.")
-            st.session_state.inputs["guidelines"] = guidelines
+            st.session_state.inputs.guidelines = guidelines
             log_to_supabase(4, "Request guidelines", guidelines, "Fetch guidelines")
             st.success("Guidelines retrieved.")
             st.session_state.stage = 5
             st.rerun()
-        else:
-            st.error("⚠️ Failed to retrieve guidelines.")
-            if st.button("Retry"):
-                log_to_supabase(4, "Retry", "", "Retry")
-                st.rerun()
-            elif st.button("Stop workflow"):
-                log_to_supabase(4, "Stop", "User stopped after failure", "Stop workflow", completed=False)
-                st.stop()
-
-    except Exception as e:
-        st.error(f"❌ Error in Step 4: {e}")
-        import traceback
-        st.text(traceback.format_exc())
-        st.stop()  # Halt execution so I can see the error
+        st.session_state.guidelines_failed = True
+
+    st.error("⚠️ Failed to retrieve guidelines.")
+    if st.button("Retry"):
+        st.session_state.guidelines_failed = False
+        log_to_supabase(4, "Retry", "", "Retry")
+        st.rerun(scope="fragment")  # retry only this stage, not the whole app
+    elif st.button("Stop workflow"):
+        log_to_supabase(4, "Stop", "User stopped after failure", "Stop workflow", completed=False)
+        st.stop()
 
 # STAGE 5: Attach and submit?
-elif stage == 5:
+@st.fragment
+def render_stage5():
     st.subheader("Step 5: Submit Documentation")
     st.markdown("Ready to submit this case.")
 
@@ -214,14 +445,15 @@ elif stage == 5:
         st.rerun()
 
 # STAGE 6: Final output
-elif stage == 6:
+@st.fragment
+def render_stage6():
     st.subheader("✅ Step 6: Submission Preview")
     st.markdown("Final structured output:")
 
     st.code(f"""
-Summary: {st.session_state.inputs.get('summary', '[Missing]')}
+Summary: {st.session_state.inputs.summary or '[Missing]'}
 
-Guidelines: {st.session_state.inputs.get('guidelines', '[Missing]')}
+Guidelines: {st.session_state.inputs.guidelines or '[Missing]'}
 
 Code: SNOMED-CT: 12345678
     """, language="text")
@@ -231,11 +463,21 @@ Code: SNOMED-CT: 12345678
 
     if st.button("🔁 Restart Demo"):
         st.session_state.stage = 1
-        st.session_state.inputs = {}
-        st.session_state.stage_start_time = datetime.utcnow()
+        st.session_state.inputs = WorkflowInputs()
+        st.session_state.stage_start_time = datetime.now(timezone.utc)
         st.rerun()
 
+STAGES = {
+    1: render_stage1,
+    2: render_stage2,
+    3: render_stage3,
+    4: render_stage4,
+    5: render_stage5,
+    6: render_stage6,
+}
+STAGES.get(stage, lambda: st.error(f"Invalid stage: {stage}"))()
+
 # Optional: View raw log in UI
 with st.expander("📊 Interaction Log"):
-    st.json({"session_id": st.session_state.session_id, "log": st.session_state.inputs})
+    st.json({"session_id": st.session_state.session_id, "log": asdict(st.session_state.inputs)})
 